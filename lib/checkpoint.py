@@ -0,0 +1,186 @@
+from lib.persistent import Persistent
+
+
+class Checkpoint(Persistent):
+    """
+    Data class representing the position within an EventHub partition up to which data has been persisted.
+    """
+    def __init__(self,
+                 fully_qualified_namespace: str,
+                 eventhub_name: str,
+                 consumer_group: str,
+                 partition_id: str,
+                 offset: str,
+                 sequence_number: int,
+                 ) -> None:
+        super().__init__()
+        self.fully_qualified_namespace = fully_qualified_namespace
+        self.eventhub_name = eventhub_name
+        self.consumer_group = consumer_group
+        self.partition_id = partition_id
+        self.offset = offset
+        self.sequence_number = sequence_number
+
+    @staticmethod
+    def from_event(partition_context, event) -> 'Checkpoint':
+        """
+        Create a checkpoint marking the provided event as the last event persisted for its partition.
+
+        :param azure.eventhub.PartitionContext partition_context: The EventHub partition context.
+        :param azure.eventhub.EventData event: The event data
+        :return: a :class:`lib.checkpoint.Checkpoint` object
+        """
+        return Checkpoint(
+            fully_qualified_namespace=partition_context.fully_qualified_namespace,
+            eventhub_name=partition_context.eventhub_name,
+            consumer_group=partition_context.consumer_group,
+            partition_id=partition_context.partition_id,
+            offset=str(event.offset),
+            sequence_number=event.sequence_number
+        )
+
+    @staticmethod
+    def from_dict(checkpoint: dict) -> 'Checkpoint':
+        """
+        Create a checkpoint from the dictionary representation used by the EventHub checkpoint store api.
+
+        :param dict checkpoint: the checkpoint dictionary
+        :return: a :class:`lib.checkpoint.Checkpoint` object
+        """
+        return Checkpoint(
+            fully_qualified_namespace=checkpoint['fully_qualified_namespace'],
+            eventhub_name=checkpoint['eventhub_name'],
+            consumer_group=checkpoint['consumer_group'],
+            partition_id=checkpoint['partition_id'],
+            offset=str(checkpoint['offset']),
+            sequence_number=checkpoint['sequence_number']
+        )
+
+    @staticmethod
+    def table_name() -> str:
+        return "event_checkpoint"
+
+    @staticmethod
+    def create_table_statements() -> [str]:
+        """
+        A series of sql statements for setting up the table that stores partition checkpoints.
+
+        :return: a list of sql statements
+        """
+        return [
+            """
+                create table if not exists public.event_checkpoint
+                (
+                    fully_qualified_namespace text not null,
+                    eventhub_name text not null,
+                    consumer_group text not null,
+                    partition_id text not null,
+                    "offset" text not null,
+                    sequence_number bigint not null,
+                    last_modified_time timestamp with time zone default current_timestamp,
+                    constraint event_checkpoint_pk
+                        primary key (fully_qualified_namespace, eventhub_name, consumer_group, partition_id)
+                );
+            """,
+        ]
+
+    @staticmethod
+    def insert_statement() -> str:
+        """
+        Parameterized sql for upserting a checkpoint. A checkpoint is never moved backwards within a partition.
+        """
+        return """INSERT INTO public.event_checkpoint
+                  VALUES (
+                    %(fully_qualified_namespace)s,
+                    %(eventhub_name)s,
+                    %(consumer_group)s,
+                    %(partition_id)s,
+                    %(offset)s,
+                    %(sequence_number)s,
+                    current_timestamp
+                   )
+                   ON CONFLICT ON CONSTRAINT event_checkpoint_pk DO UPDATE
+                   SET "offset" = excluded."offset",
+                       sequence_number = excluded.sequence_number,
+                       last_modified_time = excluded.last_modified_time
+                   WHERE event_checkpoint.sequence_number <= excluded.sequence_number;
+                """
+
+    @staticmethod
+    def select_statement() -> str:
+        """Parameterized query for listing the checkpoints of a consumer group."""
+        return """SELECT fully_qualified_namespace, eventhub_name, consumer_group, partition_id,
+                         "offset", sequence_number
+                  FROM public.event_checkpoint
+                  WHERE fully_qualified_namespace = %(fully_qualified_namespace)s
+                    AND eventhub_name = %(eventhub_name)s
+                    AND consumer_group = %(consumer_group)s"""
+
+
+class PartitionOwnership(Persistent):
+    """
+    Persistence information for the ownership of EventHub partitions, used by the consumer client to
+    balance partitions between consumer instances.
+    """
+    @staticmethod
+    def table_name() -> str:
+        return "event_ownership"
+
+    @staticmethod
+    def create_table_statements() -> [str]:
+        """
+        A series of sql statements for setting up the table that stores partition ownership.
+
+        :return: a list of sql statements
+        """
+        return [
+            """
+                create table if not exists public.event_ownership
+                (
+                    fully_qualified_namespace text not null,
+                    eventhub_name text not null,
+                    consumer_group text not null,
+                    partition_id text not null,
+                    owner_id text,
+                    etag varchar(36) not null,
+                    last_modified_time timestamp with time zone default current_timestamp,
+                    constraint event_ownership_pk
+                        primary key (fully_qualified_namespace, eventhub_name, consumer_group, partition_id)
+                );
+            """,
+        ]
+
+    @staticmethod
+    def insert_statement() -> str:
+        """
+        Parameterized sql for claiming a partition. The claim only succeeds when the partition is unowned or
+        the expected etag matches the stored etag; the claimed row is returned.
+        """
+        return """INSERT INTO public.event_ownership AS o
+                  VALUES (
+                    %(fully_qualified_namespace)s,
+                    %(eventhub_name)s,
+                    %(consumer_group)s,
+                    %(partition_id)s,
+                    %(owner_id)s,
+                    %(new_etag)s,
+                    current_timestamp
+                   )
+                   ON CONFLICT ON CONSTRAINT event_ownership_pk DO UPDATE
+                   SET owner_id = excluded.owner_id,
+                       etag = excluded.etag,
+                       last_modified_time = excluded.last_modified_time
+                   WHERE o.etag = %(etag)s
+                   RETURNING fully_qualified_namespace, eventhub_name, consumer_group, partition_id,
+                             owner_id, etag, extract(epoch from last_modified_time)::float8 as last_modified_time;
+                """
+
+    @staticmethod
+    def select_statement() -> str:
+        """Parameterized query for listing the partition ownership of a consumer group."""
+        return """SELECT fully_qualified_namespace, eventhub_name, consumer_group, partition_id,
+                         owner_id, etag, extract(epoch from last_modified_time)::float8 as last_modified_time
+                  FROM public.event_ownership
+                  WHERE fully_qualified_namespace = %(fully_qualified_namespace)s
+                    AND eventhub_name = %(eventhub_name)s
+                    AND consumer_group = %(consumer_group)s"""
@@ -30,6 +30,9 @@ class ConsumerConfig:
     checkpoint_after_messages: int = 500
     checkpoint_store_conn_str: str = None
     checkpoint_store_container_name: str = None
+    checkpoint_store_database: bool = False
+    max_save_attempts: int = 5
+    save_retry_backoff_in_seconds: int = 1
 
 
 @dataclass
@@ -44,6 +47,24 @@ class DatabaseConfig:
     password: str
     schema: str
     max_connection_attempts: int = 120
+    index_profile: str = 'query-heavy'
+    compact_data: bool = False
+    compact_drop_keys: dict = None
+
+
+@dataclass
+class ProfilingConfig:
+    """
+    Structure for housing configuration parameters related to hot path profiling
+    """
+    enabled: bool = False
+    dump_path: str = '/tmp/gdi-profile.json'
+    dump_interval_in_seconds: int = 60
+    window_size: int = 1000
+    slowest_batches: int = 10
+    sampling_interval_in_ms: int = 0
+    stall_threshold_in_ms: int = 500
+    top_stacks: int = 20
 
 
 @dataclass
@@ -55,6 +76,7 @@ class Configuration:
     """
     consumer: ConsumerConfig
     database: DatabaseConfig
+    profiling: ProfilingConfig = None
 
     @staticmethod
     def get_settings():
@@ -86,8 +108,10 @@ class Configuration:
                 data_eviction_interval_in_seconds=int(settings.get('DATA_EVICT_INTERVAL_IN_SEC',
                                                                    timedelta(hours=2).total_seconds())),
                 checkpoint_store_conn_str=settings.get('CHECKPOINT_STORE_CONNECTION'),
-                checkpoint_store_container_name=settings.get('CHECKPOINT_STORE_CONTAINER')
-
+                checkpoint_store_container_name=settings.get('CHECKPOINT_STORE_CONTAINER'),
+                checkpoint_store_database=bool(settings.get('CHECKPOINT_STORE_DATABASE', False)),
+                max_save_attempts=int(settings.get('MAX_SAVE_ATTEMPTS', 5)),
+                save_retry_backoff_in_seconds=int(settings.get('SAVE_RETRY_BACKOFF_IN_SEC', 1))
             ),
             database=DatabaseConfig(
                 host=settings.get('DB_HOST'),
@@ -96,7 +120,20 @@ class Configuration:
                 user=settings.get('DB_USER'),
                 password=settings.get('DB_PASSWORD'),
                 schema=settings.get('DB_SCHEMA'),
-                max_connection_attempts=int(settings.get('DB_MAX_CONN_ATTEMPTS', 120))
+                max_connection_attempts=int(settings.get('DB_MAX_CONN_ATTEMPTS', 120)),
+                index_profile=settings.get('DB_INDEX_PROFILE', 'query-heavy'),
+                compact_data=bool(settings.get('DB_COMPACT_DATA', False)),
+                compact_drop_keys=dict(settings.get('DB_COMPACT_DROP_KEYS', {}))
+            ),
+            profiling=ProfilingConfig(
+                enabled=bool(settings.get('PROFILE_ENABLED', False)),
+                dump_path=settings.get('PROFILE_DUMP_PATH', '/tmp/gdi-profile.json'),
+                dump_interval_in_seconds=int(settings.get('PROFILE_DUMP_INTERVAL_IN_SEC', 60)),
+                window_size=int(settings.get('PROFILE_WINDOW_SIZE', 1000)),
+                slowest_batches=int(settings.get('PROFILE_SLOWEST_BATCHES', 10)),
+                sampling_interval_in_ms=int(settings.get('PROFILE_SAMPLING_INTERVAL_IN_MS', 0)),
+                stall_threshold_in_ms=int(settings.get('PROFILE_STALL_THRESHOLD_IN_MS', 500)),
+                top_stacks=int(settings.get('PROFILE_TOP_STACKS', 20))
             )
         )
 
@@ -1,9 +1,11 @@
 import json
-from datetime import datetime, timezone
-from typing import List
+from datetime import datetime, timezone, timedelta
+from typing import List, Dict
 
+from lib.checkpoint import Checkpoint
 from lib.location import Location
 from lib.message import Message, MessageType
+from lib.profiling import profiler
 from lib.storage import MessageStorageDelegate, StorageError
 import logging
 
@@ -17,7 +19,8 @@ class MessageHandler:
     """
     def __init__(self, storage_delegate: MessageStorageDelegate,
                  buffer_size, max_buffer_time_in_sec,
-                 max_time_to_keep_data_in_seconds, data_eviction_interval_in_seconds, checkpoint_after_messages ) -> None:
+                 max_time_to_keep_data_in_seconds, data_eviction_interval_in_seconds, checkpoint_after_messages,
+                 transactional_checkpoints=False, max_save_attempts=5, save_retry_backoff_in_seconds=1) -> None:
         super().__init__()
         self.storage_delegate = storage_delegate
         self.buffer_size = buffer_size
@@ -29,6 +32,12 @@ class MessageHandler:
         self.last_buffer_flush = datetime.now(timezone.utc)
         self.last_eviction_time = datetime.now(timezone.utc)
         self.checkpoint_count = 0
+        self.transactional_checkpoints = transactional_checkpoints
+        self.pending_checkpoints: Dict[str, Checkpoint] = {}
+        self.max_save_attempts = max_save_attempts
+        self.save_retry_backoff_in_seconds = save_retry_backoff_in_seconds
+        self.failed_save_attempts = 0
+        self.next_save_attempt = None
 
     async def received_event(self, partition_context, event):
         """
@@ -48,29 +57,38 @@ class MessageHandler:
                          f" from the partition with ID: '{partition_context.partition_id}'")
             logger.debug(partition_context)
 
-            data = json.loads(event.body_as_str(encoding='UTF-8'))
+            with profiler.stage('decode'):
+                data = json.loads(event.body_as_str(encoding='UTF-8'))
             if 'messageType' in data and 'version' in data and 'data' in data:
                 _data = data.get('data', {})
-                message = Message(
-                    message_type=data.get('messageType'),
-                    message_version=data.get('version'),
-                    device_id=_data.get('deviceSerialNumber', _data.get('deviceName', None)),
-                    source_id=MessageType.get_source_id(message_type=data.get('messageType'),
-                                                        message_version=data.get('version'),
-                                                        message_data=_data),
-                    device_time=_data.get('deviceTime', _data.get('eventTime', datetime.now().timestamp())),
-                    location=Location(longitude=_data.get('longitude', 0),
-                                      latitude=_data.get('latitude', 0),
-                                      altitude=_data.get('altitude', 0)),
-                    data=_data
-                )
+                with profiler.stage('build_message'):
+                    message = Message(
+                        message_type=data.get('messageType'),
+                        message_version=data.get('version'),
+                        device_id=_data.get('deviceSerialNumber', _data.get('deviceName', None)),
+                        source_id=MessageType.get_source_id(message_type=data.get('messageType'),
+                                                            message_version=data.get('version'),
+                                                            message_data=_data),
+                        device_time=_data.get('deviceTime', _data.get('eventTime', datetime.now().timestamp())),
+                        location=Location(longitude=_data.get('longitude', 0),
+                                          latitude=_data.get('latitude', 0),
+                                          altitude=_data.get('altitude', 0)),
+                        data=_data
+                    )
                 self.buffer.append(message)
 
+            if self.transactional_checkpoints:
+                # Saved along with the buffer so the checkpoint only advances when the data is persisted
+                self.pending_checkpoints[partition_context.partition_id] = Checkpoint.from_event(partition_context,
+                                                                                                 event)
+
             buffer_delta = datetime.now(timezone.utc) - self.last_buffer_flush
-            if len(self.buffer) >= self.buffer_size or buffer_delta.total_seconds() > self.max_buffer_time_in_sec:
+            save_due = self.next_save_attempt is None or datetime.now(timezone.utc) >= self.next_save_attempt
+            if save_due and (len(self.buffer) >= self.buffer_size or
+                             buffer_delta.total_seconds() > self.max_buffer_time_in_sec):
                 self.checkpoint_count += len(self.buffer)
                 self.flush_buffer()
-                if self.checkpoint_count > self.checkpoint_after_messages:
+                if not self.transactional_checkpoints and self.checkpoint_count > self.checkpoint_after_messages:
                     try:
                         await partition_context.update_checkpoint(event)
                         self.checkpoint_count = 0
@@ -84,15 +102,53 @@ class MessageHandler:
                 eviction_cutoff = datetime.fromtimestamp(
                     datetime.now(timezone.utc).timestamp() - self.max_time_to_keep_data_in_seconds, tz=timezone.utc
                 )
-                self.storage_delegate.evict(eviction_cutoff)
+                with profiler.stage('evict'):
+                    self.storage_delegate.evict(eviction_cutoff)
 
         except Exception as e:
             logger.exception(e)
 
     def flush_buffer(self):
         try:
-            self.storage_delegate.save(self.buffer)
+            with profiler.stage('save'):
+                self.storage_delegate.save(self.buffer, list(self.pending_checkpoints.values()))
         except StorageError as se:
             logger.fatal(se)
+            if self.transactional_checkpoints:
+                profiler.end_batch(len(self.buffer), failed=True)
+                self.failed_save_attempts += 1
+                if self.failed_save_attempts < self.max_save_attempts:
+                    # Keep the batch and its checkpoints for a retry, so that a later batch cannot move
+                    # the stored checkpoint past events that were never saved.
+                    backoff = self.save_retry_backoff_in_seconds * 2 ** (self.failed_save_attempts - 1)
+                    logger.warning(f"Save attempt {self.failed_save_attempts} of {self.max_save_attempts} "
+                                   f"failed, retrying in {backoff} seconds.")
+                    self.next_save_attempt = datetime.now(timezone.utc) + timedelta(seconds=backoff)
+                    self.last_buffer_flush = datetime.now(timezone.utc)
+                    return
+                self.quarantine_buffer()
+                self.reset_buffer()
+                return
+        profiler.end_batch(len(self.buffer))
+        self.reset_buffer()
+
+    def quarantine_buffer(self):
+        """
+        Save what can be saved of a batch that has repeatedly failed, quarantining the messages that cannot
+        be saved, along with the checkpoints. If that also fails the database is unusable, so the process
+        stops rather than buffer without limit; consumption resumes from the stored checkpoints on restart.
+        """
+        try:
+            with profiler.stage('quarantine'):
+                self.storage_delegate.quarantine(self.buffer, list(self.pending_checkpoints.values()))
+        except StorageError as qe:
+            logger.fatal(f"Unable to save or quarantine {len(self.buffer)} messages after "
+                         f"{self.failed_save_attempts} attempts. Stopping.")
+            raise SystemExit(1) from qe
+
+    def reset_buffer(self):
         self.buffer.clear()
+        self.pending_checkpoints.clear()
+        self.failed_save_attempts = 0
+        self.next_save_attempt = None
         self.last_buffer_flush = datetime.now(timezone.utc)
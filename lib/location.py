@@ -1,6 +1,8 @@
 from dataclasses import dataclass
 from psycopg2.extensions import register_adapter, adapt, AsIs
 
+from lib.profiling import profiler
+
 
 @dataclass(repr=True)
 class Location:
@@ -22,9 +24,10 @@ def adapt_location(location):
     :param Location location: the location to be parameterized
     :return: None
     """
-    lon = adapt(location.longitude).getquoted().decode('utf-8')
-    lat = adapt(location.latitude).getquoted().decode('utf-8')
-    return AsIs('ST_MakePoint(%s, %s)' % (lon, lat))
+    with profiler.stage('adapt_location'):
+        lon = adapt(location.longitude).getquoted().decode('utf-8')
+        lat = adapt(location.latitude).getquoted().decode('utf-8')
+        return AsIs('ST_MakePoint(%s, %s)' % (lon, lat))
 
 # Register the adapter when the location.py file is loaded.
 register_adapter(Location, adapt_location)
@@ -2,13 +2,60 @@ import decimal
 import hashlib
 import json
 import uuid
-from datetime import datetime, timedelta
+from datetime import datetime, timedelta, timezone
 
 from dateutil import parser
 from dateutil.tz import UTC
 
 from lib.location import Location
 from lib.persistent import Persistent
+from lib.profiling import profiler
+
+
+# Secondary indexes on public.message, by profile. Every insert and eviction pays to maintain each index in
+# the profile, so the write-heavy profile keeps only what the time-bounded dashboards need.
+INDEX_PROFILES = {
+    # The original index set; favours ad hoc queries over ingest throughput.
+    'query-heavy': {
+        'message_type_idx': '(message_type)',
+        'message_type_version_idx': '(message_type, message_version)',
+        'message_device_id_idx': '(device_id)',
+        'message_source_id_idx': '(source_id)',
+        'message_device_ts_idx': '(device_timestamp)',
+        'message_location_idx': 'using GIST(location)',
+        'message_type_device_id_idx': '(message_type, device_id)',
+        'message_type_device_ts_idx': '(message_type, device_timestamp)',
+    },
+    # Drops message_type_idx, a prefix of other indexes, and replaces the device_timestamp btree with a BRIN.
+    'balanced': {
+        'message_type_version_idx': '(message_type, message_version)',
+        'message_device_id_idx': '(device_id)',
+        'message_source_id_idx': '(source_id)',
+        'message_device_ts_brin_idx': 'using BRIN(device_timestamp)',
+        'message_location_idx': 'using GIST(location)',
+        'message_type_device_id_idx': '(message_type, device_id)',
+        'message_type_device_ts_idx': '(message_type, device_timestamp)',
+    },
+    # Minimal maintenance for ingest; device_timestamp is append-mostly, so a BRIN serves eviction and
+    # time range scans at a fraction of the cost of a btree.
+    'write-heavy': {
+        'message_device_ts_brin_idx': 'using BRIN(device_timestamp)',
+        'message_type_device_ts_idx': '(message_type, device_timestamp)',
+    },
+}
+DEFAULT_INDEX_PROFILE = 'query-heavy'
+
+# Bit flags recording which keys were removed from a compact message's data because they can be rebuilt
+# exactly from a column. See :meth:`Message.compact_json_data` and :meth:`Message.upgrade_statements`.
+PROMOTED_DEVICE_SERIAL_NUMBER = 1
+PROMOTED_DEVICE_NAME = 2
+PROMOTED_DEVICE_TIME = 4
+PROMOTED_EVENT_TIME = 8
+PROMOTED_LATITUDE = 16
+PROMOTED_LONGITUDE = 32
+PROMOTED_BSSID = 64
+# Recorded as the comment on the message_expanded view; change it whenever the view definition changes.
+EXPANDED_VIEW_VERSION = 'message_expanded v1'
 
 
 class MessageType:
@@ -89,12 +136,14 @@ class Message(Persistent):
         self.device_id = device_id
         self.source_id = source_id
         self.device_time = device_time
-        self.device_timestamp = self.convert_to_timestamp(device_time)
+        with profiler.stage('convert_to_timestamp'):
+            self.device_timestamp = self.convert_to_timestamp(device_time)
 
         self.location = location
         self.data = data
         self.json_data = json.dumps(data) if data else None
-        self.id = self.generate_id()
+        with profiler.stage('generate_id'):
+            self.id = self.generate_id()
 
     def convert_to_timestamp(self, device_time):
         """
@@ -134,15 +183,65 @@ class Message(Persistent):
         return sha_signature
         # return str(uuid.uuid4())
 
+    def compact_json_data(self, drop_keys: [str] = None) -> (str, int):
+        """
+        Serialize the message data without the keys that are already stored as columns, and without any
+        configured noisy keys. A promoted key is only removed when the column holds exactly the same value,
+        so the original document can be rebuilt by the message_expanded view. Dropped keys are not rebuilt.
+
+        :param List[str] drop_keys: additional keys to remove from the data
+        :return: a tuple of the json data and the bit flags of the promoted keys that were removed
+        """
+        if not self.data:
+            return self.json_data, 0
+
+        data = {k: v for k, v in self.data.items() if not drop_keys or k not in drop_keys}
+        promoted_fields = 0
+
+        def promote(key, flag, matches):
+            nonlocal promoted_fields
+            if key in data and matches(data[key]):
+                del data[key]
+                promoted_fields |= flag
+
+        def is_number(value):
+            return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+        if 'deviceSerialNumber' in self.data:
+            promote('deviceSerialNumber', PROMOTED_DEVICE_SERIAL_NUMBER,
+                    lambda v: isinstance(v, str) and v == self.device_id)
+        else:
+            promote('deviceName', PROMOTED_DEVICE_NAME, lambda v: isinstance(v, str) and v == self.device_id)
+
+        # Only epoch milliseconds survive the round trip through device_timestamp unchanged
+        def is_epoch_millis(value):
+            return isinstance(value, int) and not isinstance(value, bool) and self.device_timestamp and \
+                   round(self.device_timestamp.replace(tzinfo=timezone.utc).timestamp() * 1000) == value
+
+        if 'deviceTime' in self.data:
+            promote('deviceTime', PROMOTED_DEVICE_TIME, is_epoch_millis)
+        else:
+            promote('eventTime', PROMOTED_EVENT_TIME, is_epoch_millis)
+
+        if self.location:
+            promote('latitude', PROMOTED_LATITUDE, lambda v: is_number(v) and v == self.location.latitude)
+            promote('longitude', PROMOTED_LONGITUDE, lambda v: is_number(v) and v == self.location.longitude)
+
+        if self.message_type == 'WifiBeaconRecord':
+            promote('bssid', PROMOTED_BSSID, lambda v: isinstance(v, str) and v == self.source_id)
+
+        return json.dumps(data), promoted_fields
+
     @staticmethod
     def table_name() -> str:
         return "message"
 
     @staticmethod
-    def create_table_statements() -> [str]:
+    def create_table_statements(index_profile: str = DEFAULT_INDEX_PROFILE) -> [str]:
         """
         A series of sql statements for settings up database artifacts necessary to store and query the messages.
 
+        :param str index_profile: the name of the secondary index profile to create. See :data:`INDEX_PROFILES`.
         :return: a list of sql statements
         """
         return [
@@ -158,20 +257,120 @@ class Message(Persistent):
                     device_timestamp timestamp with time zone,
                     location geography(POINT),
                     data jsonb,
-                    source_id text
+                    source_id text,
+                    promoted_fields smallint
                 );
             
             """,
-            "create index message_type_idx on public.message(message_type);",
-            "create index message_type_version_idx on public.message(message_type, message_version);",
-            "create index message_device_id_idx on public.message(device_id);",
-            "create index message_source_id_idx on public.message(source_id);",
-            "create index message_device_ts_idx on public.message(device_timestamp);",
-            "create index message_location_idx on public.message using GIST(location);",
-            "create index message_type_device_id_idx on public.message(message_type, device_id);",
-            "create index message_type_device_ts_idx on public.message(message_type, device_timestamp);",
+        ] + Message.create_index_statements(index_profile)
+
+    @staticmethod
+    def upgrade_statements() -> [str]:
+        """
+        A series of idempotent sql statements for bringing an existing message table up to date, including
+        the message_expanded view which rebuilds the original data document of compact messages.
+
+        :return: a list of sql statements
+        """
+        return Message.promoted_fields_column_statements() + Message.expanded_view_statements()
+
+    @staticmethod
+    def schema_state_statement() -> str:
+        """
+        Query returning whether the promoted_fields column exists and the version recorded on the
+        message_expanded view, so upgrades only take locks when the schema is out of date.
+        """
+        return """select exists(select 1 from information_schema.columns
+                                where table_schema = 'public'
+                                  and table_name = 'message'
+                                  and column_name = 'promoted_fields') as has_promoted_fields,
+                         obj_description(to_regclass('public.message_expanded'), 'pg_class') as view_version"""
+
+    @staticmethod
+    def promoted_fields_column_statements() -> [str]:
+        """Sql statements adding the promoted_fields column to an existing message table."""
+        return ["alter table public.message add column if not exists promoted_fields smallint;"]
+
+    @staticmethod
+    def expanded_view_statements() -> [str]:
+        """
+        Sql statements (re)creating the message_expanded view, which rebuilds the original data document of
+        compact messages, and recording its version. See :data:`EXPANDED_VIEW_VERSION`.
+        """
+        return [
+            f"""
+                create or replace view public.message_expanded as
+                select
+                    id,
+                    message_type,
+                    message_version,
+                    device_id,
+                    device_timestamp,
+                    location,
+                    case when coalesce(promoted_fields, 0) = 0 then data
+                    else data || jsonb_strip_nulls(jsonb_build_object(
+                        'deviceSerialNumber',
+                            case when promoted_fields & {PROMOTED_DEVICE_SERIAL_NUMBER} > 0 then device_id end,
+                        'deviceName',
+                            case when promoted_fields & {PROMOTED_DEVICE_NAME} > 0 then device_id end,
+                        'deviceTime',
+                            case when promoted_fields & {PROMOTED_DEVICE_TIME} > 0
+                                then round(extract(epoch from device_timestamp) * 1000)::bigint end,
+                        'eventTime',
+                            case when promoted_fields & {PROMOTED_EVENT_TIME} > 0
+                                then round(extract(epoch from device_timestamp) * 1000)::bigint end,
+                        'latitude',
+                            case when promoted_fields & {PROMOTED_LATITUDE} > 0 then st_y(location::geometry) end,
+                        'longitude',
+                            case when promoted_fields & {PROMOTED_LONGITUDE} > 0 then st_x(location::geometry) end,
+                        'bssid',
+                            case when promoted_fields & {PROMOTED_BSSID} > 0 then source_id end
+                    )) end as data,
+                    source_id
+                from public.message;
+            """,
+            f"comment on view public.message_expanded is '{EXPANDED_VIEW_VERSION}';",
         ]
 
+    @staticmethod
+    def index_names(index_profile: str = DEFAULT_INDEX_PROFILE) -> [str]:
+        """
+        The names of the secondary indexes that make up an index profile.
+
+        :param str index_profile: the name of the index profile
+        :return: a list of index names
+        """
+        if index_profile not in INDEX_PROFILES:
+            raise ValueError(f"Unknown index profile [{index_profile}], expected one of {list(INDEX_PROFILES)}")
+        return list(INDEX_PROFILES[index_profile])
+
+    @staticmethod
+    def create_index_statements(index_profile: str = DEFAULT_INDEX_PROFILE, concurrently: bool = False) -> [str]:
+        """
+        A series of sql statements for creating the secondary indexes of an index profile. Statements built
+        with concurrently=True must be run outside of a transaction.
+
+        :param str index_profile: the name of the index profile
+        :param bool concurrently: build the indexes without locking out writes
+        :return: a list of sql statements
+        """
+        return [f"create index {'concurrently ' if concurrently else ''}if not exists {name} "
+                f"on public.message {INDEX_PROFILES[index_profile][name]};"
+                for name in Message.index_names(index_profile)]
+
+    @staticmethod
+    def drop_index_statements(index_names: [str], concurrently: bool = False) -> [str]:
+        """
+        A series of sql statements for dropping secondary indexes. Statements built with concurrently=True
+        must be run outside of a transaction.
+
+        :param List[str] index_names: the names of the indexes to drop
+        :param bool concurrently: drop the indexes without locking out reads and writes
+        :return: a list of sql statements
+        """
+        return [f"drop index {'concurrently ' if concurrently else ''}if exists public.{name};"
+                for name in index_names]
+
     @staticmethod
     def insert_statement() -> str:
         """Parameterized sql for inserting a message into the database."""
@@ -184,13 +383,88 @@ class Message(Persistent):
                     %(device_timestamp)s,
                     %(location)s,
                     %(json_data)s,
-                    %(source_id)s
+                    %(source_id)s,
+                    %(promoted_fields)s
                    )
                    ON CONFLICT DO NOTHING;
                 """
 
+    @staticmethod
+    def index_usage_statement() -> str:
+        """
+        Query reporting, for each index on the message table, how often it has been used against the
+        number of row writes that have had to maintain it since the statistics were last reset.
+        """
+        return """select s.indexrelname as index_name,
+                         i.indisprimary as is_primary,
+                         s.idx_scan,
+                         s.idx_tup_read,
+                         s.idx_tup_fetch,
+                         pg_relation_size(s.indexrelid) as index_size_bytes,
+                         t.n_tup_ins + t.n_tup_upd + t.n_tup_del as table_writes
+                  from pg_stat_user_indexes s
+                      join pg_stat_user_tables t on t.relid = s.relid
+                      join pg_index i on i.indexrelid = s.indexrelid
+                  where s.schemaname = 'public'
+                    and s.relname = 'message'
+                  order by s.idx_scan, index_size_bytes desc"""
+
     @staticmethod
     def delete_statement() -> str:
         """Parametrized query for removing aged out messages"""
         return """delete from public.message where device_timestamp <= %(device_timestamp)s"""
 
+
+
+class QuarantinedMessage(Persistent):
+    """
+    Persistence information for messages that could not be saved, so that consumption can move past them
+    without losing them.
+    """
+    @staticmethod
+    def parameters(message: Message, error: Exception) -> dict:
+        """
+        The insert parameters for quarantining a message.
+
+        :param Message message: the message that could not be saved
+        :param Exception error: the reason the message could not be saved
+        :return: a dictionary of parameters for :meth:`insert_statement`
+        """
+        return {
+            'message_type': str(message.message_type),
+            'error': str(error),
+            'message': json.dumps({
+                'messageType': message.message_type,
+                'version': message.message_version,
+                'data': message.data
+            }, default=str)
+        }
+
+    @staticmethod
+    def table_name() -> str:
+        return "message_quarantine"
+
+    @staticmethod
+    def create_table_statements() -> [str]:
+        """
+        A series of sql statements for setting up the table that stores quarantined messages.
+
+        :return: a list of sql statements
+        """
+        return [
+            """
+                create table if not exists public.message_quarantine
+                (
+                    quarantined_time timestamp with time zone default current_timestamp,
+                    message_type text,
+                    error text,
+                    message text
+                );
+            """,
+        ]
+
+    @staticmethod
+    def insert_statement() -> str:
+        """Parameterized sql for quarantining a message."""
+        return """INSERT INTO public.message_quarantine (message_type, error, message)
+                  VALUES (%(message_type)s, %(error)s, %(message)s);"""
@@ -0,0 +1,252 @@
+import asyncio
+import heapq
+import itertools
+import json
+import logging
+import sys
+import threading
+import time
+from collections import deque, defaultdict, Counter
+from datetime import datetime, timezone
+from typing import Deque, Dict, List
+
+from lib.config import ProfilingConfig
+
+logger = logging.getLogger(__name__)
+
+
+class _NullStage:
+    """Context manager used for every stage while profiling is disabled, so disabled timing costs one check."""
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        return False
+
+
+_NULL_STAGE = _NullStage()
+
+
+class _Stage:
+    """Context manager timing a single execution of a stage."""
+    __slots__ = ('profiler', 'name', 'start')
+
+    def __init__(self, profiler: 'StageProfiler', name: str) -> None:
+        self.profiler = profiler
+        self.name = name
+        self.start = 0.0
+
+    def __enter__(self):
+        self.profiler._depth += 1
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        duration = time.perf_counter() - self.start
+        self.profiler._depth -= 1
+        self.profiler.record(self.name, duration, top_level=self.profiler._depth == 0)
+        return False
+
+
+class StageProfiler:
+    """
+    Collects timings for the stages of the ingest hot path. Keeps a rolling window of durations per stage and
+    traces of the slowest batches, where a batch trace is the time spent in each stage since the previous
+    buffer flush. Stages nest (e.g. adapt_location runs within execute_batch), so stage times are inclusive and
+    a batch total only counts the outermost stages.
+
+    Profiling can be switched at runtime with :meth:`toggle` and the collected data written to a local file
+    with :meth:`dump`. Optionally, a sampling thread records the stacks of the event loop thread, separately
+    counting the samples taken while the event loop is stalled.
+    """
+    def __init__(self, config: ProfilingConfig = None) -> None:
+        super().__init__()
+        self.config = config or ProfilingConfig()
+        self.enabled = self.config.enabled
+        self._lock = threading.Lock()
+        self._batch_sequence = itertools.count()
+        self._sampler = None
+        self._loop_heartbeat = time.perf_counter()
+        self._depth = 0
+        self.reset()
+
+    def configure(self, config: ProfilingConfig):
+        """
+        Apply a new configuration, discarding any collected data.
+        :param ProfilingConfig config: the profiling configuration
+        :return: None
+        """
+        self.config = config
+        self.enabled = config.enabled
+        self.reset()
+
+    def reset(self):
+        """Discard all collected timings, batch traces and stack samples."""
+        with self._lock:
+            self.durations: Dict[str, Deque[float]] = defaultdict(lambda: deque(maxlen=self.config.window_size))
+            self.counts: Dict[str, int] = Counter()
+            self.totals: Dict[str, float] = defaultdict(float)
+            self.batch_stages: Dict[str, float] = defaultdict(float)
+            self.batch_total = 0.0
+            self.slowest_batches = []
+            self.samples: Dict[str, int] = Counter()
+            self.stalled_samples: Dict[str, int] = Counter()
+            self.last_dump = time.monotonic()
+
+    def toggle(self):
+        """
+        Switch profiling on or off. Data collected so far is dumped when profiling is switched off. The
+        partial trace of the current batch is discarded, so it is not added to the next batch profiled.
+        """
+        self.enabled = not self.enabled
+        self.batch_stages = defaultdict(float)
+        self.batch_total = 0.0
+        logger.warning(f"Profiling {'enabled' if self.enabled else 'disabled'}.")
+        if not self.enabled:
+            self.dump()
+
+    def stage(self, name: str):
+        """
+        A context manager timing the enclosed block as an execution of the named stage.
+        :param str name: the name of the stage
+        :return: a context manager
+        """
+        return _Stage(self, name) if self.enabled else _NULL_STAGE
+
+    def record(self, name: str, duration: float, top_level: bool = True):
+        """
+        Record an execution of a stage.
+        :param str name: the name of the stage
+        :param float duration: the duration of the execution in seconds
+        :param bool top_level: whether the stage ran outside of any other stage, and so counts toward the
+                               batch total without being counted twice
+        :return: None
+        """
+        self.durations[name].append(duration)
+        self.counts[name] += 1
+        self.totals[name] += duration
+        self.batch_stages[name] += duration
+        if top_level:
+            self.batch_total += duration
+
+    def end_batch(self, size: int, failed: bool = False):
+        """
+        Close the trace of the current batch, keeping it if it is one of the slowest, and dump the collected
+        data if the dump interval has passed.
+        :param int size: the number of messages in the batch
+        :param bool failed: whether the batch failed to save and will be retried
+        :return: None
+        """
+        if not self.enabled:
+            return
+        total = self.batch_total
+        trace = {
+            'ended': datetime.now(timezone.utc).isoformat(),
+            'messages': size,
+            'failed': failed,
+            'stages_ms': {name: round(duration * 1000, 3) for name, duration in self.batch_stages.items()},
+        }
+        entry = (total, next(self._batch_sequence), trace)
+        with self._lock:
+            if len(self.slowest_batches) < self.config.slowest_batches:
+                heapq.heappush(self.slowest_batches, entry)
+            else:
+                heapq.heappushpop(self.slowest_batches, entry)
+        self.batch_stages = defaultdict(float)
+        self.batch_total = 0.0
+
+        if self.config.dump_interval_in_seconds and \
+                time.monotonic() - self.last_dump > self.config.dump_interval_in_seconds:
+            self.dump()
+
+    def report(self) -> dict:
+        """
+        Summarize the collected data.
+        :return: a dictionary of per stage statistics, the slowest batch traces and the most frequent stacks
+        """
+        def percentile(ordered: List[float], fraction: float) -> float:
+            return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+        stages = {}
+        for name, durations in list(self.durations.items()):
+            ordered = sorted(durations)
+            if not ordered:
+                continue
+            stages[name] = {
+                'count': self.counts[name],
+                'total_seconds': round(self.totals[name], 3),
+                'window_mean_ms': round(1000 * sum(ordered) / len(ordered), 3),
+                'window_p50_ms': round(1000 * percentile(ordered, 0.5), 3),
+                'window_p95_ms': round(1000 * percentile(ordered, 0.95), 3),
+                'window_max_ms': round(1000 * ordered[-1], 3),
+            }
+        with self._lock:
+            slowest = [dict(trace, total_ms=round(total * 1000, 3))
+                       for total, _, trace in sorted(self.slowest_batches, reverse=True)]
+            samples = self.samples.most_common(self.config.top_stacks)
+            stalled_samples = self.stalled_samples.most_common(self.config.top_stacks)
+        return {
+            'generated': datetime.now(timezone.utc).isoformat(),
+            'enabled': self.enabled,
+            'stages': dict(sorted(stages.items(), key=lambda item: item[1]['total_seconds'], reverse=True)),
+            'slowest_batches': slowest,
+            'stack_samples': [{'count': count, 'stack': stack} for stack, count in samples],
+            'stalled_stack_samples': [{'count': count, 'stack': stack} for stack, count in stalled_samples],
+        }
+
+    def dump(self, path: str = None):
+        """
+        Write the report to a local file.
+        :param str path: the file to write, defaults to the configured dump path
+        :return: None
+        """
+        path = path or self.config.dump_path
+        self.last_dump = time.monotonic()
+        try:
+            with open(path, 'w') as f:
+                json.dump(self.report(), f, indent=2)
+            logger.info(f"Profile written to [{path}]")
+        except Exception:
+            logger.exception(f"Unable to write profile to [{path}]")
+
+    def start_sampling(self):
+        """
+        Start the sampling thread, if a sampling interval is configured, for the calling thread which should
+        be running the event loop.
+        :return: None
+        """
+        if self.config.sampling_interval_in_ms and not self._sampler:
+            self._sampler = threading.Thread(target=self._sample, args=(threading.get_ident(),),
+                                             name='profile-sampler', daemon=True)
+            self._sampler.start()
+
+    async def watch_event_loop(self):
+        """Coroutine that marks the event loop as responsive, for detecting stalls while sampling."""
+        interval = self.config.stall_threshold_in_ms / 4000.0
+        while True:
+            self._loop_heartbeat = time.perf_counter()
+            await asyncio.sleep(interval)
+
+    def _sample(self, thread_id: int):
+        interval = self.config.sampling_interval_in_ms / 1000.0
+        stall_threshold = self.config.stall_threshold_in_ms / 1000.0
+        while True:
+            time.sleep(interval)
+            if not self.enabled:
+                continue
+            frame = sys._current_frames().get(thread_id)
+            if frame is None:
+                return
+            frames = []
+            while frame is not None:
+                frames.append(f"{frame.f_code.co_filename}:{frame.f_code.co_name}:{frame.f_lineno}")
+                frame = frame.f_back
+            stack = ';'.join(reversed(frames))
+            with self._lock:
+                self.samples[stack] += 1
+                if time.perf_counter() - self._loop_heartbeat > stall_threshold:
+                    self.stalled_samples[stack] += 1
+
+
+# The profiler shared by the hot path. Configured at startup by main.
+profiler = StageProfiler()
@@ -1,17 +1,23 @@
 import logging
 import time
+import uuid
 from abc import abstractmethod
-from datetime import datetime
+from contextlib import contextmanager
+from datetime import datetime, timezone
 from pprint import pformat
-from typing import List
+from typing import List, Iterable, Dict, Any
 
 import psycopg2
+from azure.eventhub.aio import CheckpointStore
 from psycopg2 import OperationalError
-from psycopg2.extras import execute_batch
+from psycopg2.errors import UndefinedTable
+from psycopg2.extras import execute_batch, RealDictCursor
 
+from lib.checkpoint import Checkpoint, PartitionOwnership
 from lib.config import DatabaseConfig
-from lib.message import Message
+from lib.message import Message, QuarantinedMessage, INDEX_PROFILES, EXPANDED_VIEW_VERSION
 from lib.persistent import Persistent
+from lib.profiling import profiler
 
 logger = logging.getLogger(__name__)
 
@@ -38,11 +44,25 @@ class MessageStorageDelegate:
     Provides storage services for incoming data.
     """
     @abstractmethod
-    def save(self, messages: List[Persistent]):
+    def save(self, messages: List[Persistent], checkpoints: List[Checkpoint] = None):
         """
-        Save a :class:List of :class:Persistent objects to the database.
+        Save a :class:List of :class:Persistent objects to the database. If checkpoints are provided, they
+        are saved within the same transaction as the messages.
 
         :param List[Persistent] messages: The messages to save.
+        :param List[Checkpoint] checkpoints: The partition checkpoints covering the messages.
+        :return: None
+        """
+        pass
+
+    @abstractmethod
+    def quarantine(self, messages: List[Persistent], checkpoints: List[Checkpoint] = None):
+        """
+        Save the messages that can be saved and set aside those that cannot, along with the checkpoints,
+        so that consumption can move past messages that will never save.
+
+        :param List[Persistent] messages: The messages to save.
+        :param List[Checkpoint] checkpoints: The partition checkpoints covering the messages.
         :return: None
         """
         pass
@@ -68,6 +88,8 @@ class PostgresMessageStorageDelegate(MessageStorageDelegate):
         self._connection = None
 
     def wait_for_and_setup_connection(self):
+        # Fail fast on an unknown index profile rather than when the table is first created
+        Message.index_names(self.config.index_profile)
         self.__connect()
         connection_attempts = 1
         while not self.connected() and connection_attempts <= self.config.max_connection_attempts:
@@ -79,6 +101,8 @@ class PostgresMessageStorageDelegate(MessageStorageDelegate):
         if self.connected():
             if not self.table_exists():
                 self.create_table()
+            else:
+                self.upgrade_table()
         return self.connected()
 
     def connected(self):
@@ -120,45 +144,262 @@ class PostgresMessageStorageDelegate(MessageStorageDelegate):
         """Create the table in the database."""
         with self.connection as conn:
             with conn.cursor() as cursor:
-                for statement in Message.create_table_statements():
+                self._create_table(cursor)
+
+    def _create_table(self, cursor):
+        for statement in Message.create_table_statements(self.config.index_profile) + \
+                Message.upgrade_statements():
+            cursor.execute(statement)
+
+    def upgrade_table(self):
+        """
+        Bring an existing table, and its dependent views, up to date. DDL is only run when the schema is out
+        of date, since altering the table takes a lock that waits behind, and then blocks, running queries.
+        """
+        with self.connection as conn:
+            with conn.cursor() as cursor:
+                cursor.execute(Message.schema_state_statement())
+                has_promoted_fields, view_version = cursor.fetchone()
+                statements = []
+                if not has_promoted_fields:
+                    statements += Message.promoted_fields_column_statements()
+                if view_version != EXPANDED_VIEW_VERSION:
+                    statements += Message.expanded_view_statements()
+                for statement in statements:
+                    logger.info(statement)
                     cursor.execute(statement)
 
+    def _message_parameters(self, message: Message) -> dict:
+        """The insert parameters for a message, in the compact storage format when configured."""
+        parameters = {**vars(message), 'promoted_fields': None}
+        if message.device_timestamp and message.device_timestamp.tzinfo is None:
+            # The naive timestamp is UTC; mark it so, otherwise postgres reads it in the session time zone.
+            # It is bound here rather than in Message so that the message id hash is unchanged.
+            parameters['device_timestamp'] = message.device_timestamp.replace(tzinfo=timezone.utc)
+        if self.config.compact_data:
+            drop_keys = (self.config.compact_drop_keys or {}).get(message.message_type)
+            with profiler.stage('compact_data'):
+                parameters['json_data'], parameters['promoted_fields'] = message.compact_json_data(drop_keys)
+        return parameters
+
+    @contextmanager
+    def _autocommit_cursor(self):
+        """A cursor on a connection in autocommit mode, for statements that cannot run in a transaction."""
+        conn = self.connection
+        conn.autocommit = True
+        try:
+            with conn.cursor() as cursor:
+                yield cursor
+        finally:
+            conn.autocommit = False
+
+    def secondary_indexes(self) -> Dict[str, bool]:
+        """
+        The managed secondary indexes that currently exist on the message table.
+
+        :return: a dictionary of index name to whether the index is valid. An index left by a failed or
+                 cancelled concurrent build is invalid.
+        """
+        managed = {name for profile in INDEX_PROFILES.values() for name in profile}
+        with self.connection as conn:
+            with conn.cursor() as cursor:
+                cursor.execute("SELECT c.relname, i.indisvalid FROM pg_index i "
+                               "JOIN pg_class c ON c.oid = i.indexrelid "
+                               "JOIN pg_class t ON t.oid = i.indrelid "
+                               "JOIN pg_namespace n ON n.oid = t.relnamespace "
+                               "WHERE n.nspname = 'public' "
+                               "AND t.relname = %(table_name)s", {'table_name': Message.table_name()})
+                return {row[0]: row[1] for row in cursor.fetchall() if row[0] in managed}
+
+    def secondary_index_names(self) -> List[str]:
+        """The names of the managed secondary indexes that currently exist on the message table."""
+        return list(self.secondary_indexes())
+
+    def drop_secondary_indexes(self):
+        """Concurrently drop all of the managed secondary indexes on the message table."""
+        with self._autocommit_cursor() as cursor:
+            for statement in Message.drop_index_statements(self.secondary_index_names(), concurrently=True):
+                logger.info(statement)
+                cursor.execute(statement)
+
+    def apply_index_profile(self):
+        """
+        Bring the secondary indexes on the message table in line with the configured index profile. Indexes
+        that are not part of the profile, or are invalid, are dropped and missing indexes are built, both
+        concurrently so ingest can continue.
+        """
+        wanted = Message.index_names(self.config.index_profile)
+        unwanted = [name for name, valid in self.secondary_indexes().items() if name not in wanted or not valid]
+        with self._autocommit_cursor() as cursor:
+            for statement in Message.drop_index_statements(unwanted, concurrently=True) + \
+                    Message.create_index_statements(self.config.index_profile, concurrently=True):
+                logger.info(statement)
+                cursor.execute(statement)
+
+    def index_usage_report(self) -> List[Dict[str, Any]]:
+        """
+        Report the usage of each index on the message table against its maintenance cost, in number of
+        row writes, since the database statistics were last reset.
+
+        :return: a list of dictionaries, one per index, least used first
+        """
+        with self.connection as conn:
+            with conn.cursor(cursor_factory=RealDictCursor) as cursor:
+                cursor.execute(Message.index_usage_statement())
+                report = [dict(row) for row in cursor.fetchall()]
+        for row in report:
+            row['scans_per_1000_writes'] = round(1000 * row['idx_scan'] / row['table_writes'], 3) \
+                if row['table_writes'] else None
+        return report
+
     def evict(self, older_than: datetime):
         statement = Message.delete_statement()
         try:
             with self.connection as conn:
                 with conn.cursor() as cursor:
-                    cursor.execute(statement, {'device_timestamp': older_than})
+                    with profiler.stage('evict_delete'):
+                        cursor.execute(statement, {'device_timestamp': older_than})
         except Exception:
             logger.exception(f"Unable to delete messages prior to [{older_than}]")
 
-    def save(self, messages: List[Message]):
+    def create_checkpoint_tables(self):
+        """Create the checkpoint and partition ownership tables in the database, if they do not exist."""
+        with self.connection as conn:
+            with conn.cursor() as cursor:
+                for statement in Checkpoint.create_table_statements() + PartitionOwnership.create_table_statements():
+                    cursor.execute(statement)
+
+    def save(self, messages: List[Message], checkpoints: List[Checkpoint] = None):
         """
-        Save the messages to the data store. The messages must all be of the same message type.
+        Save the messages to the data store. The messages must all be of the same message type. The
+        checkpoints, if any, are written in the same transaction so that the stored partition positions
+        never get ahead of, or fall behind, the stored data.
 
         :param List[Message] messages: a list of Message objects
+        :param List[Checkpoint] checkpoints: a list of Checkpoint objects
         :return: None
         """
-        if messages:
+        if messages or checkpoints:
             statement = Message.insert_statement()
             try:
                 with self.connection as conn:
                     with conn.cursor() as cursor:
 
-                        all_messages = [{
-                            **vars(message)
-                        } for message in messages]
+                        all_messages = [self._message_parameters(message) for message in messages]
 
-                        try:
+                        if all_messages:
                             logger.info(f"Inserting {len(all_messages)} messages. "
                                         f"(from: {all_messages[0]['device_timestamp'].isoformat()} "
                                         f"to: {all_messages[-1]['device_timestamp'].isoformat()})")
                             logger.debug(pformat(all_messages))
-                            execute_batch(cursor, statement, all_messages)
-                        except Exception as e:
-                            logger.warning("Unable to insert row, checking to ensure table exists.")
-                            if not self.table_exists():
-                                self.create_table()
+                            try:
+                                with profiler.stage('execute_batch'):
+                                    execute_batch(cursor, statement, all_messages)
+                            except UndefinedTable:
+                                # Nothing else has been written in this transaction, so roll it back, create
+                                # the table and retry. Any other failure aborts the save, checkpoints included.
+                                logger.warning("Unable to insert rows, the table does not exist. Creating it.")
+                                conn.rollback()
+                                self._create_table(cursor)
                                 execute_batch(cursor, statement, all_messages)
+
+                        if checkpoints:
+                            with profiler.stage('save_checkpoints'):
+                                execute_batch(cursor, Checkpoint.insert_statement(),
+                                              [vars(checkpoint) for checkpoint in checkpoints])
             except Exception as e:
                 raise StorageError(f"Unable to store messages [{messages}]") from e
+
+    def quarantine(self, messages: List[Message], checkpoints: List[Checkpoint] = None):
+        """
+        Save the messages one at a time, moving any message that fails to the message_quarantine table, and
+        save the checkpoints, all in a single transaction.
+
+        :param List[Message] messages: a list of Message objects
+        :param List[Checkpoint] checkpoints: a list of Checkpoint objects
+        :return: None
+        """
+        statement = Message.insert_statement()
+        try:
+            with self.connection as conn:
+                with conn.cursor() as cursor:
+                    for create_statement in QuarantinedMessage.create_table_statements():
+                        cursor.execute(create_statement)
+                    for message in messages:
+                        cursor.execute("SAVEPOINT quarantine")
+                        try:
+                            cursor.execute(statement, self._message_parameters(message))
+                            cursor.execute("RELEASE SAVEPOINT quarantine")
+                        except Exception as e:
+                            cursor.execute("ROLLBACK TO SAVEPOINT quarantine")
+                            logger.error(f"Quarantining message [{message.id}]: {e}")
+                            cursor.execute(QuarantinedMessage.insert_statement(),
+                                           QuarantinedMessage.parameters(message, e))
+                    if checkpoints:
+                        execute_batch(cursor, Checkpoint.insert_statement(),
+                                      [vars(checkpoint) for checkpoint in checkpoints])
+        except Exception as e:
+            raise StorageError(f"Unable to quarantine messages [{messages}]") from e
+
+
+class PostgresCheckpointStore(CheckpointStore):
+    """
+    An EventHub checkpoint store that keeps partition checkpoints and ownership in the same postgres
+    database as the messages. Checkpoints are normally written by
+    :meth:`PostgresMessageStorageDelegate.save` in the same transaction as the messages they cover, so
+    a restarted consumer resumes exactly where the persisted data ends.
+
+    For more information on checkpoint stores, please refer to `CheckpointStore <https://docs.microsoft.com/en-us/python/api/azure-eventhub/azure.eventhub.aio.checkpointstore?view=azure-python>`_.
+    """
+    def __init__(self, storage_delegate: PostgresMessageStorageDelegate) -> None:
+        super().__init__()
+        self.storage_delegate = storage_delegate
+
+    def create_tables(self):
+        """Create the tables backing the checkpoint store."""
+        self.storage_delegate.create_checkpoint_tables()
+
+    def _query(self, statement: str, parameters) -> List[Dict[str, Any]]:
+        with self.storage_delegate.connection as conn:
+            with conn.cursor(cursor_factory=RealDictCursor) as cursor:
+                cursor.execute(statement, parameters)
+                return [dict(row) for row in cursor.fetchall()]
+
+    async def list_ownership(self, fully_qualified_namespace: str, eventhub_name: str, consumer_group: str,
+                             **kwargs: Any) -> Iterable[Dict[str, Any]]:
+        return self._query(PartitionOwnership.select_statement(), {
+            'fully_qualified_namespace': fully_qualified_namespace,
+            'eventhub_name': eventhub_name,
+            'consumer_group': consumer_group
+        })
+
+    async def claim_ownership(self, ownership_list: Iterable[Dict[str, Any]],
+                              **kwargs: Any) -> Iterable[Dict[str, Any]]:
+        claimed = []
+        for ownership in ownership_list:
+            try:
+                claimed.extend(self._query(PartitionOwnership.insert_statement(), {
+                    'fully_qualified_namespace': ownership['fully_qualified_namespace'],
+                    'eventhub_name': ownership['eventhub_name'],
+                    'consumer_group': ownership['consumer_group'],
+                    'partition_id': ownership['partition_id'],
+                    'owner_id': ownership['owner_id'],
+                    'etag': ownership.get('etag'),
+                    'new_etag': str(uuid.uuid4())
+                }))
+            except Exception:
+                logger.exception(f"Unable to claim ownership of partition [{ownership['partition_id']}]")
+        return claimed
+
+    async def update_checkpoint(self, checkpoint: Dict[str, Any], **kwargs: Any) -> None:
+        with self.storage_delegate.connection as conn:
+            with conn.cursor() as cursor:
+                cursor.execute(Checkpoint.insert_statement(), vars(Checkpoint.from_dict(checkpoint)))
+
+    async def list_checkpoints(self, fully_qualified_namespace: str, eventhub_name: str, consumer_group: str,
+                               **kwargs: Any) -> Iterable[Dict[str, Any]]:
+        return self._query(Checkpoint.select_statement(), {
+            'fully_qualified_namespace': fully_qualified_namespace,
+            'eventhub_name': eventhub_name,
+            'consumer_group': consumer_group
+        })
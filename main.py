@@ -1,10 +1,13 @@
+import argparse
 import asyncio
+import signal
 from pprint import pformat
 from azure.eventhub.aio import EventHubConsumerClient, EventHubSharedKeyCredential
 from azure.eventhub.extensions.checkpointstoreblobaio import BlobCheckpointStore
 from lib.config import ConsumerConfig, Configuration
-from lib.storage import PostgresMessageStorageDelegate, MessageStorageDelegate
+from lib.storage import PostgresMessageStorageDelegate, MessageStorageDelegate, PostgresCheckpointStore
 from lib.handler import MessageHandler
+from lib.profiling import profiler
 import logging
 
 logging.basicConfig(
@@ -69,24 +72,23 @@ async def consume(config: ConsumerConfig, delegate: MessageStorageDelegate):
     """
     # Create a consumer client for the event hub.
     logger.info(f"Consuming {config}")
+    checkpoint_store = None
     if config.checkpoint_store_conn_str and config.checkpoint_store_container_name:
         # Use an azure blob storage container to store position within partition
         checkpoint_store = BlobCheckpointStore.from_connection_string(config.checkpoint_store_conn_str,
                                                                       config.checkpoint_store_container_name)
-        client = EventHubConsumerClient(
-            fully_qualified_namespace=config.fully_qualified_namespace,
-            consumer_group=config.consumer_group,
-            eventhub_name=config.topic,
-            credential=EventHubSharedKeyCredential(config.shared_access_policy, config.key),
-            checkpoint_store=checkpoint_store
-        )
-    else:
-        client = EventHubConsumerClient(
-            fully_qualified_namespace=config.fully_qualified_namespace,
-            consumer_group=config.consumer_group,
-            eventhub_name=config.topic,
-            credential=EventHubSharedKeyCredential(config.shared_access_policy, config.key)
-        )
+    elif config.checkpoint_store_database and isinstance(delegate, PostgresMessageStorageDelegate):
+        # Store position within partition in the database, in the same transaction as the data
+        checkpoint_store = PostgresCheckpointStore(storage_delegate=delegate)
+        checkpoint_store.create_tables()
+
+    client = EventHubConsumerClient(
+        fully_qualified_namespace=config.fully_qualified_namespace,
+        consumer_group=config.consumer_group,
+        eventhub_name=config.topic,
+        credential=EventHubSharedKeyCredential(config.shared_access_policy, config.key),
+        checkpoint_store=checkpoint_store
+    )
 
     handler = MessageHandler(
         storage_delegate=delegate,
@@ -94,9 +96,17 @@ async def consume(config: ConsumerConfig, delegate: MessageStorageDelegate):
         max_buffer_time_in_sec=config.max_buffer_time_in_seconds,
         max_time_to_keep_data_in_seconds=config.max_time_to_keep_data_in_seconds,
         data_eviction_interval_in_seconds=config.data_eviction_interval_in_seconds,
-        checkpoint_after_messages=config.checkpoint_after_messages
+        checkpoint_after_messages=config.checkpoint_after_messages,
+        transactional_checkpoints=isinstance(checkpoint_store, PostgresCheckpointStore),
+        max_save_attempts=config.max_save_attempts,
+        save_retry_backoff_in_seconds=config.save_retry_backoff_in_seconds
     )
 
+    if profiler.config.sampling_interval_in_ms:
+        # Sample the stacks of this thread, which runs the event loop, to find where stalls are spent
+        profiler.start_sampling()
+        asyncio.ensure_future(profiler.watch_event_loop())
+
     async with client:
         await client.receive(on_event=handler.received_event,
                              on_error=errored,
@@ -104,11 +114,43 @@ async def consume(config: ConsumerConfig, delegate: MessageStorageDelegate):
                              on_partition_initialize=partition_initialized,
                              starting_position=-1)
 
+
+def report_index_usage(delegate: PostgresMessageStorageDelegate):
+    """
+    Print the usage of each index on the message table against its maintenance cost, to guide the choice
+    of index profile.
+    :param delegate: A Postgres storage delegate object
+    :return: None
+    """
+    columns = ['index_name', 'idx_scan', 'table_writes', 'scans_per_1000_writes', 'index_size_bytes']
+    print(' '.join(f"{column:>28}" for column in columns))
+    for row in delegate.index_usage_report():
+        print(' '.join(f"{str(row[column]):>28}" for column in columns))
+
+
 if __name__ == '__main__':
+    arg_parser = argparse.ArgumentParser(description="Grafana DataIntegration")
+    arg_parser.add_argument('command', nargs='?', default='consume',
+                            choices=['consume', 'index-report', 'apply-index-profile', 'drop-indexes'],
+                            help="consume the topic (default), report index usage, apply the configured "
+                                 "index profile, or drop the secondary indexes ahead of a bulk load")
+    args = arg_parser.parse_args()
+
     configuration = Configuration.get_config()
     logger.info(f"Starting Grafana DataIntegration with \n{pformat(vars(configuration))}")
     storage_delegate = PostgresMessageStorageDelegate(config=configuration.database)
     storage_delegate.wait_for_and_setup_connection()
-    loop = asyncio.get_event_loop()
-    loop.run_until_complete(consume(config=configuration.consumer, delegate=storage_delegate))
-
+    if args.command == 'index-report':
+        report_index_usage(storage_delegate)
+    elif args.command == 'apply-index-profile':
+        storage_delegate.apply_index_profile()
+    elif args.command == 'drop-indexes':
+        storage_delegate.drop_secondary_indexes()
+    else:
+        profiler.configure(configuration.profiling)
+        loop = asyncio.get_event_loop()
+        if hasattr(signal, 'SIGUSR1'):
+            # SIGUSR1 switches profiling on and off, SIGUSR2 writes the current profile to the dump path
+            loop.add_signal_handler(signal.SIGUSR1, profiler.toggle)
+            loop.add_signal_handler(signal.SIGUSR2, profiler.dump)
+        loop.run_until_complete(consume(config=configuration.consumer, delegate=storage_delegate))